@@ -27,14 +27,33 @@ rebase_shift_attr = '_rebased_shift'
 bounds = 'bounds'
 boundsvar = 'bounds_var'
 
+# Length in seconds of time units that are the same in every calendar
+unit_seconds = {'days': 86400, 'day': 86400,
+                'hours': 3600, 'hour': 3600,
+                'minutes': 60, 'minute': 60,
+                'seconds': 1, 'second': 1}
+
 # Code adapted from https://github.com/spencerahill/aospy/issues/212
 
 def date2num_round(dates, units, calendar):
     return np.round(date2num(dates, units, calendar),8)
 
 def rebase_times(values, input_units, calendar, output_units):
-    dates = num2date(values, input_units, calendar)
-    return date2num_round(dates, output_units, calendar)
+    """
+    Convert times in input_units to output_units. When both units are fixed
+    length (days, hours, ...) this is a linear transformation, so only the
+    reference date is decoded rather than every value, which is slow for
+    dates far from the reference.
+    """
+    try:
+        input_step = unit_seconds[input_units.split(' since ')[0].strip().lower()]
+        output_step = unit_seconds[output_units.split(' since ')[0].strip().lower()]
+    except KeyError:
+        dates = num2date(values, input_units, calendar)
+        return date2num_round(dates, output_units, calendar)
+
+    shift = date2num(num2date(0, input_units, calendar), output_units, calendar)
+    return np.round(values * (input_step / output_step) + shift, 8)
 
 def is_bounds(var):
     """
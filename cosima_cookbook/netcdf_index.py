@@ -16,12 +16,15 @@ import sys
 import fnmatch
 import dask.bag
 import distributed
-from distributed.diagnostics.progressbar import progress
 import xarray as xr
-import subprocess
+import concurrent.futures
+import functools
+import itertools
 import tqdm
 import IPython.display
 import pickle
+import ast
+import sqlalchemy
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -37,7 +40,217 @@ directoriesToSearch = ['/g/data3/hh5/tmp/cosima/',
 
 database_url = database_url_from_path('/g/data3/hh5/tmp/cosima/cosima-cookbook')
 
-def build_index(use_bag=False, careful=False, expt_dir_list=None):
+def connect_database(db_url):
+    """
+    Connect to the database at db_url. SQLite queries get a memory-mapped
+    database, a larger page cache and in-memory temporary tables.
+    """
+    db = dataset.connect(db_url)
+
+    if db.engine.dialect.name == 'sqlite':
+        @sqlalchemy.event.listens_for(db.engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            # read-side tuning only, so read-only users can still connect
+            cursor.execute('PRAGMA temp_store=MEMORY')
+            cursor.execute('PRAGMA mmap_size=268435456')  # 256 MiB
+            cursor.execute('PRAGMA cache_size=-262144')  # 256 MiB
+            cursor.close()
+
+    return db
+
+# columns of the ncfiles table, one row per variable per file
+ncfiles_columns = ['ncfile', 'rootdir', 'configuration', 'experiment', 'run',
+                   'basename', 'basename_pattern', 'variable',
+                   'dimensions', 'chunking']
+
+def ncfiles_table(db):
+    """
+    Return the SQLAlchemy table for ncfiles, creating the table and any
+    missing columns up front so rows can be inserted without dataset
+    inspecting each one for schema changes.
+    """
+    table = db['ncfiles']
+    for column in ncfiles_columns:
+        if not table.has_column(column):
+            table.create_column(column, db.types.text)
+
+    return table.table
+
+def insert_ncfiles(db, table, rows):
+    """
+    Insert rows into the ncfiles table. For SQLite, rows are grouped into
+    multi-row INSERT ... VALUES statements binding at most 999 parameters
+    (SQLite's default limit), so each statement is prepared once for many
+    rows rather than once per row. This goes straight to the DB-API cursor
+    as SQLAlchemy compiles every multi-row insert afresh, which is slower
+    than the executemany it replaces.
+    """
+    if not rows:
+        # an executemany with no parameters would insert a single empty row
+        return
+
+    if db.engine.dialect.name != 'sqlite':
+        db.executable.execute(table.insert(), rows)
+        return
+
+    chunk_size = 999 // len(ncfiles_columns)
+    placeholders = '(' + ','.join('?' * len(ncfiles_columns)) + ')'
+
+    def insert_sql(nrows):
+        return 'INSERT INTO {} ({}) VALUES {}'.format(table.name, ','.join(ncfiles_columns),
+                                                      ','.join([placeholders] * nrows))
+
+    # every chunk but the last is full, so reuses the same statement
+    full_sql = insert_sql(chunk_size)
+
+    cursor = db.executable.connection.cursor()
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        sql = full_sql if len(chunk) == chunk_size else insert_sql(len(chunk))
+        cursor.execute(sql, [row[column] for row in chunk for column in ncfiles_columns])
+    cursor.close()
+
+def find_output_dirs(directory, maxdepth):
+    """
+    Yield the output??? directories at most maxdepth levels below directory.
+    Symbolic links are not followed.
+    """
+    stack = [(directory, 0)]
+    while stack:
+        path, depth = stack.pop()
+        if depth >= maxdepth:
+            continue
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if fnmatch.fnmatch(entry.name, 'output???'):
+                        yield entry.path
+                    stack.append((entry.path, depth + 1))
+
+def find_ncfiles(directory):
+    """
+    Yield the .nc files anywhere below directory. Symbolic links to
+    directories are not followed.
+    """
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.nc'):
+                    yield entry.path
+
+def encode_dimensions(dimensions):
+    """
+    Encode a tuple of dimension names for the index as a comma-separated string.
+    """
+    return ','.join(dimensions)
+
+def parse_dimensions(dimensions):
+    """
+    Return the tuple of dimension names stored in the index. Older indexes
+    stored the repr of the tuple, which is also accepted.
+    """
+    if dimensions.startswith('('):
+        return ast.literal_eval(dimensions)
+    if not dimensions:
+        return ()
+
+    return tuple(dimensions.split(','))
+
+def encode_chunking(chunking):
+    """
+    Encode the result of netCDF4.Variable.chunking() for the index as chunk
+    sizes separated by '|', or an empty string if the variable is not chunked
+    ('contiguous', or None for netCDF3 files).
+    """
+    if isinstance(chunking, (list, tuple)):
+        return '|'.join(str(c) for c in chunking)
+
+    return ''
+
+def parse_chunking(chunking):
+    """
+    Return the tuple of chunk sizes stored in the index, or None if the
+    variable is not chunked. Older indexes stored the repr of the list,
+    which is also accepted.
+    """
+    if chunking.startswith('['):
+        return tuple(ast.literal_eval(chunking))
+    if chunking in ('', 'None', 'contiguous'):
+        return None
+
+    return tuple(int(c) for c in chunking.split('|'))
+
+# output* directories
+# match the parent and grandparent directory to configuration/experiment
+find_output = re.compile('(.*)/([^/]*)/([^/]*)/(output\d+)/.*\.nc')
+
+# determine general pattern for ncfile names
+find_basename_pattern = re.compile('(?P<root>[^\d]+)(?P<index>__\d+_\d+)?(?P<indexice>\.\d+\-\d+)?(?P<ext>\.nc)')
+
+@functools.lru_cache(maxsize=None)
+def get_basename_pattern(basename):
+    """
+    Return the general pattern for an ncfile basename, with any tile or
+    date indices replaced by regular expressions. The same few basenames
+    recur in every run directory, so results are cached.
+    """
+    m = find_basename_pattern.match(basename)
+    if m is None:
+        return basename
+
+    return m.group('root') + ('__\d+_\d+' if m.group('index') else '') + ('.\d+-\d+' if m.group('indexice') else '') + m.group('ext')
+
+def index_variables(ncfile):
+    """
+    Return a list of index rows, one for each variable in ncfile, and an
+    error message if the file could not be read (or None). The message is
+    returned rather than printed, as this runs in a worker process whose
+    output does not reach the notebook.
+    """
+
+    matched = find_output.match(ncfile)
+    if matched is None:
+        return [], None
+
+    # TODO: also exit here if ncfile is already in database - use [NOT] EXISTS ??
+    # but this is super slow
+    # module load sqlite
+    # sqlite3 /g/data3/hh5/tmp/cosima/cosima-cookbook/cosima-cookbook.db
+    # select * from ncfiles where ncfile == '/g/data3/hh5/tmp/cosima/access-om2-025/025deg_jra55v13_ryf8485_KDS50/output024/ocean/ocean_scalar.nc';
+
+    basename = os.path.basename(ncfile)
+
+    # fields shared by every variable in this file
+    common = {'ncfile': ncfile,
+              'rootdir': matched.group(1),
+              'configuration': matched.group(2),
+              'experiment' : matched.group(3),
+              'run' : matched.group(4),
+              'basename' : basename,
+              'basename_pattern' : get_basename_pattern(basename),
+              }
+
+    try:
+        # a single open both checks the file exists and reads its metadata
+        with netCDF4.Dataset(ncfile, mode='r') as ds:
+            ncvars = [ dict(common,
+               variable=v.name,
+               dimensions=encode_dimensions(v.dimensions),
+               chunking=encode_chunking(v.chunking()),
+               ) for v in ds.variables.values()]
+    except FileNotFoundError:
+        # removed since the directory scan, or a broken link
+        return [], None
+    except:
+        return [], '{0} exception occurred while trying to read {1}'.format(sys.exc_info()[0], ncfile)
+
+    return ncvars, None
+
+def build_index(use_bag=False, careful=False, expt_dir_list=None, nprocs=None):
     """
     An experiment is a collection of outputNNN directories.  Each directory
     represents the output of a single job submission script. These directories
@@ -58,6 +271,10 @@ def build_index(use_bag=False, careful=False, expt_dir_list=None):
              You must have write access to all these directories.
              If expt_dir_list=None (the default), a central database is used.
 
+        nprocs: number of processes used to read .nc files when use_bag is False.
+             Separate processes are used because netCDF4/HDF5 are not thread
+             safe. Default is the number of CPUs available to this process.
+
     We can also examine the .nc files directly to infer their contents.
     for each .nc file, get variables -> dimensions
 
@@ -84,10 +301,7 @@ def build_index(use_bag=False, careful=False, expt_dir_list=None):
         runs_available = []
         # find all output subdirectories
         try:
-            results = subprocess.check_output(['find', directoryToSearch, '-maxdepth', str(maxdepth), '-type', 'd',
-                '-name', 'output???'])
-            results = [s for s in results.decode('utf-8').split()]
-            runs_available.extend(results)
+            runs_available.extend(find_output_dirs(directoryToSearch, maxdepth))
         except:
             print ('{0} exception occurred while finding output directories in {1}'.format(sys.exc_info()[0], directoryToSearch))
 
@@ -106,14 +320,15 @@ def build_index(use_bag=False, careful=False, expt_dir_list=None):
 
         # In this database is a single table listing all variables in NetCDF4 seen previously.
         print('Using database {}'.format(db_url))
-        db = dataset.connect(db_url)
+        db = connect_database(db_url)
         db['ncfiles']
         # db.create_table('ncfiles')  # has no effect if 'ncfiles' table already exists
 
         if not (db_url == prev_db_url):  # avoid repeating db query when expt_dir_list is None
             runs_already_seen = set([])
             files_already_seen = set([]) 
-            if db['ncfiles'].count() > 0:  # this also creates 'ncfiles' table if db is new
+            # LIMIT 1 lookup rather than counting every row just to test for emptiness
+            if db['ncfiles'].find_one() is not None:
                 if careful:  # filter by filename rather than dir
                     print('Querying database for files... ', end='')
                     rf = db.query('SELECT DISTINCT ncfile FROM ncfiles')
@@ -126,7 +341,8 @@ def build_index(use_bag=False, careful=False, expt_dir_list=None):
                     print('Querying database for directories... ', end='')
                     # find list of all run directories
                     r = db.query('SELECT DISTINCT rootdir, configuration, experiment, run FROM ncfiles')
-                    runs_already_seen = set([os.path.join(*row.values()) for row in r])
+                    # rootdir has no trailing slash, so a plain join rebuilds the run path
+                    runs_already_seen = {'/'.join(row.values()) for row in r}
                     print('run directories already indexed: {}'.format(len(runs_already_seen)))
         prev_db_url = db_url
 
@@ -146,9 +362,7 @@ def build_index(use_bag=False, careful=False, expt_dir_list=None):
         ncfiles = []
         for run in tqdm.tqdm_notebook(runs_to_index, leave=False):
             try:
-                results = subprocess.check_output(['find', run, '-name', '*.nc'])
-                results = [s for s in results.decode('utf-8').split()]
-                ncfiles.extend(results)
+                ncfiles.extend(find_ncfiles(run))
             except:
                 print ('{0} exception occurred while finding *.nc in {1}'.format(sys.exc_info()[0], run))
 
@@ -161,54 +375,6 @@ def build_index(use_bag=False, careful=False, expt_dir_list=None):
         # For these new files, we can determine their configuration, experiment, and run.
         # Using NetCDF4 to get list of all variables in each file.
 
-        # output* directories
-        # match the parent and grandparent directory to configuration/experiment
-        find_output = re.compile('(.*)/([^/]*)/([^/]*)/(output\d+)/.*\.nc')
-
-        # determine general pattern for ncfile names
-        find_basename_pattern = re.compile('(?P<root>[^\d]+)(?P<index>__\d+_\d+)?(?P<indexice>\.\d+\-\d+)?(?P<ext>\.nc)')
-
-        def index_variables(ncfile):
-
-            matched = find_output.match(ncfile)
-            if matched is None:
-                return []
-
-            if not os.path.exists(ncfile):
-                return []
-
-    # TODO: also exit here if ncfile is already in database - use [NOT] EXISTS ??
-    # but this is super slow
-    # module load sqlite
-    # sqlite3 /g/data3/hh5/tmp/cosima/cosima-cookbook/cosima-cookbook.db
-    # select * from ncfiles where ncfile == '/g/data3/hh5/tmp/cosima/access-om2-025/025deg_jra55v13_ryf8485_KDS50/output024/ocean/ocean_scalar.nc';
-
-            basename = os.path.basename(ncfile)
-            m = find_basename_pattern.match(basename)
-            if m is None:
-                basename_pattern = basename
-            else:
-                basename_pattern = m.group('root') + ('__\d+_\d+' if m.group('index') else '') + ('.\d+-\d+' if m.group('indexice') else '') + m.group('ext')
-
-            try:
-                with netCDF4.Dataset(ncfile) as ds:
-                    ncvars = [ {'ncfile': ncfile,
-                       'rootdir': matched.group(1),
-                       'configuration': matched.group(2),
-                       'experiment' : matched.group(3),
-                       'run' : matched.group(4),
-                       'basename' : basename,
-                       'basename_pattern' : basename_pattern,
-                       'variable' : v.name,
-                       'dimensions' : str(v.dimensions),
-                       'chunking' : str(v.chunking()),
-                       } for v in ds.variables.values()]
-            except:
-                print ('{0} exception occurred while trying to read {1}'.format(sys.exc_info()[0], ncfile))
-                ncvars = []
-
-            return ncvars
-
         if len(files_to_add) == 0:
             print('No new .nc files found in {}'.format(directoryToSearch))
             continue
@@ -217,24 +383,48 @@ def build_index(use_bag=False, careful=False, expt_dir_list=None):
 
         if use_bag:
             with distributed.Client() as client:
-                bag = dask.bag.from_sequence(files_to_add)
-                bag = bag.map(index_variables).flatten()
+                futures = client.map(index_variables, list(files_to_add))
 
-                futures = client.compute(bag)
-                progress(futures, notebook=False)
-
-                ncvars = futures.result()
+                # collect results as they arrive, releasing them on the workers
+                ncvars = []
+                errors = []
+                for future in tqdm.tqdm_notebook(distributed.as_completed(futures),
+                                                 total=len(futures), leave=False):
+                    rows, error = future.result()
+                    ncvars.extend(rows)
+                    if error is not None:
+                        errors.append(error)
+                    future.release()
         else:
-            ncvars = []
-            for file_to_add in tqdm.tqdm_notebook(files_to_add, leave=False):
-                ncvars.extend(index_variables(file_to_add))
-            IPython.display.clear_output()
+            if nprocs is None:
+                # only the CPUs this process may use, not every core on a shared node
+                if hasattr(os, 'sched_getaffinity'):
+                    nprocs = len(os.sched_getaffinity(0))
+                else:
+                    nprocs = os.cpu_count()
+            with concurrent.futures.ProcessPoolExecutor(max_workers=nprocs) as executor:
+                results = executor.map(index_variables, files_to_add, chunksize=16)
+                results = list(tqdm.tqdm_notebook(results, total=len(files_to_add), leave=False))
+            ncvars = list(itertools.chain.from_iterable(rows for rows, error in results))
+            errors = [error for rows, error in results if error is not None]
+        IPython.display.clear_output()
+
+        for error in errors:
+            print(error)
 
         print('')
         print('Indexed {} variables found in new files'.format(len(ncvars)))
 
         print('Saving results in database {}... '.format(db_url))
-        db['ncfiles'].insert_many(ncvars)
+        # insert all rows in a single transaction
+        table = ncfiles_table(db)
+        db.begin()
+        try:
+            insert_ncfiles(db, table, ncvars)
+            db.commit()
+        except:
+            db.rollback()
+            raise
 
     print('Indexing complete.')
 
@@ -245,10 +435,9 @@ def get_configurations():
     """
     Returns list of all configurations
     """
-    db = dataset.connect(database_url)
-
-    rows = db.query('SELECT DISTINCT configuration FROM ncfiles')
-    configurations = [row['configuration'] for row in rows]
+    with connect_database(database_url) as db:
+        rows = db.query('SELECT DISTINCT configuration FROM ncfiles')
+        configurations = [row['configuration'] for row in rows]
 
     return configurations
 
@@ -257,11 +446,10 @@ def get_experiments(configuration):
     """
     Returns list of all experiments for the given configuration
     """
-    db = dataset.connect(database_url)
-
-    rows = db.query('SELECT DISTINCT experiment FROM ncfiles '
-                'WHERE configuration = "{configuration}" ORDER BY experiment'.format(configuration=configuration), )
-    expts = [row['experiment'] for row in rows]
+    with connect_database(database_url) as db:
+        rows = db.query('SELECT DISTINCT experiment FROM ncfiles '
+                    'WHERE configuration = "{configuration}" ORDER BY experiment'.format(configuration=configuration), )
+        expts = [row['experiment'] for row in rows]
 
     return expts
 
@@ -269,7 +457,7 @@ def get_ncfiles(expt):
     """
     Returns list of ncfiles for the given experiment
     """
-    with dataset.connect(database_url) as db:
+    with connect_database(database_url) as db:
         rows = db.query('SELECT DISTINCT basename_pattern '
                         'FROM ncfiles '
                         f'WHERE experiment = "{expt}"')
@@ -287,7 +475,7 @@ def get_variables(expt, ncfile):
     and regular expressions also work in some limited cases.
     """
 
-    with dataset.connect(database_url) as db:
+    with connect_database(database_url) as db:
         rows = db.query('SELECT DISTINCT variable '
                         'FROM ncfiles '
                         f'WHERE experiment = "{expt}" '
@@ -413,8 +601,6 @@ def get_nc_variable(expt, ncfile,
         else:
             db_url = database_url
         print('Using database {}'.format(db_url))
-        db = dataset.connect(db_url)
-
         var_list = ",".join(['"{}"'.format(v) for v in variables])
 
         sql = " ".join(['SELECT DISTINCT ncfile, dimensions, chunking ',
@@ -429,8 +615,8 @@ def get_nc_variable(expt, ncfile,
 
         logging.debug(sql)
 
-        res = db.query(sql)
-        rows = list(res)
+        with connect_database(db_url) as db:
+            rows = list(db.query(sql))
 
         ncfiles = [row['ncfile'] for row in rows]
 
@@ -441,8 +627,8 @@ def get_nc_variable(expt, ncfile,
 
         #print('Found {} ncfiles'.format(len(ncfiles)))
 
-        dimensions = eval(rows[0]['dimensions'])
-        chunking = eval(rows[0]['chunking'])
+        dimensions = parse_dimensions(rows[0]['dimensions'])
+        chunking = parse_chunking(rows[0]['chunking'])
 
         #print ('chunking info', dimensions, chunking)
         if chunking is not None:
@@ -502,12 +688,11 @@ def get_nc_variable(expt, ncfile,
         return out
 
 def get_scalar_variables(configuration):
-    db = dataset.connect(database_url)
-
-    rows = db.query('SELECT DISTINCT variable FROM ncfiles '
-         'WHERE basename = "ocean_scalar.nc" '
-         'AND dimensions = "(\'time\', \'scalar_axis\')" '
-         'AND configuration = "{configuration}"'.format(configuration=configuration))
-    variables = [row['variable'] for row in rows]
+    with connect_database(database_url) as db:
+        rows = db.query('SELECT DISTINCT variable FROM ncfiles '
+             'WHERE basename = "ocean_scalar.nc" '
+             'AND dimensions IN ("time,scalar_axis", "(\'time\', \'scalar_axis\')") '
+             'AND configuration = "{configuration}"'.format(configuration=configuration))
+        variables = [row['variable'] for row in rows]
 
     return variables
@@ -7,6 +7,25 @@
 
 import f90nml  # from http://f90nml.readthedocs.io/en/latest/
 import os
+import copy
+
+# parsed namelists, keyed by path, with the modification time when read
+_nmlcache = {}
+
+
+def _nmlread(nmlfname):
+    """Return Namelist from a FORTRAN namelist file, only parsing the
+        file again if it has been modified since it was last read.
+
+    Input: namelist file path string
+    Output: copy of the Namelist, which may be safely modified (e.g. by nmldiff)
+    """
+    mtime = os.stat(nmlfname).st_mtime
+    cached = _nmlcache.get(nmlfname)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, f90nml.read(nmlfname))
+        _nmlcache[nmlfname] = cached
+    return copy.deepcopy(cached[1])
 
 
 def nmldict(nmlfnames):
@@ -24,7 +43,7 @@ def nmldict(nmlfnames):
     nmlall = {}  # dict keys are nml paths, values are Namelist dicts
     for nml in nmlfnames:
         if os.path.exists(nml):
-            nmlall[nml] = f90nml.read(nml)
+            nmlall[nml] = _nmlread(nml)
     return nmlall
 
 
@@ -18,6 +18,7 @@ setup(
         'matplotlib',
         'bokeh',
         'dataset',
+        'sqlalchemy',
         'dask',
         'distributed',
         'netcdf4',
@@ -26,7 +26,7 @@ import cftime
 from datetime import datetime, timedelta
 
 from cosima_cookbook.date_utils import rebase_times, rebase_dataset, \
-    rebase_variable, rebase_shift_attr
+    rebase_variable, rebase_shift_attr, date2num_round
 
 from xarray.testing import assert_equal
 
@@ -57,6 +57,15 @@ def test_rebase_times():
     # Should be a -10 year offset between original times and rebased times
     assert(not np.any((times - 365*10) - rebase_times(times,'days since 1980-01-01','noleap','days since 1990-01-01')))
 
+def test_rebase_times_units():
+
+    # Fast path must agree with decoding every date, including across units
+    for input_units, output_units in [('days since 1980-01-01', 'days since 1970-01-01'),
+                                      ('days since 1980-01-01', 'hours since 1900-01-01'),
+                                      ('hours since 1980-01-01', 'days since 1990-01-01')]:
+        expected = date2num_round(cftime.num2date(times, input_units, 'noleap'), output_units, 'noleap')
+        assert(np.allclose(rebase_times(times, input_units, 'noleap', output_units), expected))
+
 def test_rebase_variable():
 
     timesvar = xr.DataArray(times,attrs={'units':'days since 1980-01-01','calendar':'noleap'})
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+import netCDF4
+
+from cosima_cookbook.netcdf_index import encode_dimensions, parse_dimensions, \
+    encode_chunking, parse_chunking, connect_database, database_url_from_path, \
+    ncfiles_table, ncfiles_columns, insert_ncfiles, find_output_dirs, find_ncfiles
+
+def test_dimensions():
+
+    for dimensions in [('time', 'yt_ocean', 'xt_ocean'), ('time',), ()]:
+        assert(parse_dimensions(encode_dimensions(dimensions)) == dimensions)
+        # Indexes written by older versions stored the repr of the tuple
+        assert(parse_dimensions(str(dimensions)) == dimensions)
+
+    assert(encode_dimensions(('time', 'scalar_axis')) == 'time,scalar_axis')
+
+def test_chunking():
+
+    assert(parse_chunking(encode_chunking([1, 300, 360])) == (1, 300, 360))
+    assert(parse_chunking(encode_chunking('contiguous')) is None)
+    assert(parse_chunking(encode_chunking(None)) is None)
+
+    # Indexes written by older versions stored the repr of the list
+    assert(parse_chunking(str([1, 300, 360])) == (1, 300, 360))
+    assert(parse_chunking(str(None)) is None)
+    assert(parse_chunking('contiguous') is None)
+
+def test_encode_file():
+
+    testfile = 'test/data/ocean_sealevel.nc'
+
+    with netCDF4.Dataset(testfile) as ds:
+        v = ds.variables['sea_level']
+        assert(parse_dimensions(encode_dimensions(v.dimensions)) == v.dimensions)
+        assert(parse_chunking(encode_chunking(v.chunking())) is None)
+
+def make_tree(root):
+    """
+    Make a small experiment tree under root, with .nc files, a non-.nc file
+    and symbolic links that find would not follow or match with -type d
+    """
+    expt = root / 'conf' / 'expt'
+    for path in ['output000/ocean/a.nc', 'output000/ocean/restart/b.nc',
+                 'output000/ocean/notes.txt', 'output001/ocean/c.nc']:
+        (expt / path).parent.mkdir(parents=True, exist_ok=True)
+        (expt / path).touch()
+    (root / 'output005').mkdir()
+    (expt / 'output000' / 'linked').symlink_to(expt / 'output001' / 'ocean')
+    (expt / 'output002').symlink_to(expt / 'output000')
+    (root / 'alias').symlink_to(root / 'conf')
+
+    return expt
+
+def test_find_output_dirs(tmp_path):
+
+    expt = make_tree(tmp_path)
+
+    # maxdepth counts like find -maxdepth, with the starting directory at depth 0
+    assert(set(find_output_dirs(str(tmp_path), 1)) == {str(tmp_path / 'output005')})
+    assert(set(find_output_dirs(str(tmp_path), 2)) == {str(tmp_path / 'output005')})
+    # symlinked directories (output002 and alias/expt/...) are neither matched nor followed
+    assert(set(find_output_dirs(str(tmp_path), 3)) == {str(tmp_path / 'output005'),
+                                                        str(expt / 'output000'),
+                                                        str(expt / 'output001')})
+    assert(set(find_output_dirs(str(expt), 1)) == {str(expt / 'output000'),
+                                                    str(expt / 'output001')})
+
+def test_find_ncfiles(tmp_path):
+
+    expt = make_tree(tmp_path)
+
+    # only .nc files, recursing into subdirectories but not symlinked ones
+    assert(set(find_ncfiles(str(expt / 'output000'))) == {str(expt / 'output000/ocean/a.nc'),
+                                                          str(expt / 'output000/ocean/restart/b.nc')})
+    assert(set(find_ncfiles(str(expt))) == {str(expt / 'output000/ocean/a.nc'),
+                                            str(expt / 'output000/ocean/restart/b.nc'),
+                                            str(expt / 'output001/ocean/c.nc')})
+
+def test_insert_ncfiles(tmp_path):
+
+    # More than two full multi-row INSERT chunks, plus a partial one
+    rows = [{column: '{}{}'.format(column, i) for column in ncfiles_columns}
+            for i in range(250)]
+
+    db = connect_database(database_url_from_path(str(tmp_path)))
+    table = ncfiles_table(db)
+    db.begin()
+    insert_ncfiles(db, table, rows)
+    db.commit()
+
+    assert(db['ncfiles'].count() == len(rows))
+    stored = list(db.query('SELECT {} FROM ncfiles ORDER BY id'.format(','.join(ncfiles_columns))))
+    assert([dict(row) for row in stored] == rows)
+
+    # Inserting nothing must not add an empty row
+    db.begin()
+    insert_ncfiles(db, table, [])
+    db.commit()
+    assert(db['ncfiles'].count() == len(rows))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+
+from cosima_cookbook.summary import nml_diff
+from cosima_cookbook.summary.nml_diff import nmldict, nmldiff
+
+def test_nmldict_cache(tmp_path, monkeypatch):
+
+    nml = str(tmp_path / 'input.nml')
+    with open(nml, 'w') as f:
+        f.write('&grp\n  a = 1\n  b = 2\n/\n')
+
+    # Count how often the file is actually parsed
+    reads = []
+    read = nml_diff.f90nml.read
+    def counting_read(fname):
+        reads.append(fname)
+        return read(fname)
+    monkeypatch.setattr(nml_diff.f90nml, 'read', counting_read)
+
+    first = nmldict((nml,))
+    first[nml]['grp']['a'] = 99
+    del first[nml]['grp']['b']
+
+    # A second call returns an unmodified copy without parsing again
+    second = nmldict((nml,))
+    assert(second[nml]['grp']['a'] == 1)
+    assert(second[nml]['grp']['b'] == 2)
+    assert(len(reads) == 1)
+
+    # nmldiff modifies its input in place, which must not reach the cache
+    other = str(tmp_path / 'other.nml')
+    with open(other, 'w') as f:
+        f.write('&grp\n  a = 1\n  b = 3\n/\n')
+    nmldiff(nmldict((nml, other)))
+    assert(nmldict((nml,))[nml]['grp']['a'] == 1)
+
+    # A new modification time causes the file to be parsed again
+    with open(nml, 'w') as f:
+        f.write('&grp\n  a = 5\n  b = 2\n/\n')
+    mtime = os.stat(nml).st_mtime
+    os.utime(nml, (mtime + 10, mtime + 10))
+    reads.clear()
+    assert(nmldict((nml,))[nml]['grp']['a'] == 5)
+    assert(reads == [nml])